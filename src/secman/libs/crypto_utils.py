@@ -6,6 +6,12 @@ and encrypting/decrypting values using the Fernet algorithm.
 
 Dependencies:
 - cryptography (https://pypi.org/project/cryptography/)
+- rfernet (https://pypi.org/project/rfernet/), optional: when installed, it is used
+  to encrypt/decrypt values instead of cryptography's Fernet, as it is faster
+- PyNaCl (https://pypi.org/project/PyNaCl/), optional: required to encrypt new values
+  with libsodium's SecretBox (XSalsa20-Poly1305), selected by setting the environment
+  variable SECMAN_CIPHER to "nacl". Fernet stays the default, and decryption detects
+  the format of each token, so both kinds of values can live in the same file
 
 Example usage:
     # Generate a new encryption key
@@ -27,15 +33,42 @@ Example usage:
 
     # Decrypt a value using a Fernet key
     decrypted_value = decrypt_value(encrypted_value, key)
+
+    # Reuse a single cipher when processing many values with the same key
+    cipher = make_cipher(key)
+    encrypted_values = [encrypt_value_with(cipher, value) for value in ("one", "two")]
+
+    # Decrypt values of any format, building each cipher once
+    ciphers = {}
+    decrypted_values = [
+        decrypt_value_with(cipher_for_token(ciphers, key, value), value)
+        for value in encrypted_values
+    ]
 """
 
 import os
 import base64
+import binascii
+import hashlib
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
 
+try:
+    from rfernet import Fernet as RFernet
+except ImportError:
+    RFernet = None
+
+try:
+    from nacl.secret import SecretBox
+except ImportError:
+    SecretBox = None
+
+# Environment variable selecting the cipher used to encrypt new values
+CIPHER_ENV = "SECMAN_CIPHER"
+DEFAULT_CIPHER = "fernet"
+
 
 def generate_key():
     """
@@ -111,9 +144,188 @@ def is_valid_fernet_key(key):
         return False
 
 
+class SecretBoxCipher(object):
+    """
+    libsodium SecretBox (XSalsa20-Poly1305) cipher, with the same interface as Fernet
+
+    The box key is the SHA256 of the master key. Tokens are the urlsafe base64
+    encoding of a version byte, the nonce and the ciphertext. The version byte
+    (0x02) tells these tokens apart from Fernet ones, which start with 0x80.
+    """
+
+    VERSION = b"\x02"
+
+    def __init__(self, master_key) -> None:
+        if SecretBox is None:
+            raise ImportError("PyNaCl is required to use the nacl cipher")
+        if isinstance(master_key, str):
+            master_key = master_key.encode()
+        self._box = SecretBox(hashlib.sha256(master_key).digest())
+
+    def encrypt(self, data: bytes) -> bytes:
+        return base64.urlsafe_b64encode(self.VERSION + self._box.encrypt(data))
+
+    def decrypt(self, token: bytes) -> bytes:
+        raw = base64.urlsafe_b64decode(token)
+        if raw[:1] != self.VERSION:
+            raise ValueError("Not a SecretBox token")
+        return self._box.decrypt(raw[1:])
+
+
+def cipher_name_for_token(encrypted_value):
+    """
+    Tell which cipher produced an encrypted value, from its version byte.
+
+    Parameters:
+    - encrypted_value (str): The encrypted value.
+
+    Returns:
+    - str: "nacl" for SecretBox tokens, "fernet" otherwise.
+    """
+    if isinstance(encrypted_value, str):
+        encrypted_value = encrypted_value.encode()
+    try:
+        version = base64.urlsafe_b64decode(encrypted_value[:4])[:1]
+    except (binascii.Error, ValueError):
+        return DEFAULT_CIPHER
+    return "nacl" if version == SecretBoxCipher.VERSION else DEFAULT_CIPHER
+
+
+def get_cipher_name(cipher_name=None):
+    """
+    Validate the name of the cipher to use for encryption.
+
+    Parameters:
+    - cipher_name (str, optional): "fernet" or "nacl", case insensitive. If not
+      provided, it is taken from the SECMAN_CIPHER environment variable,
+      defaulting to "fernet".
+
+    Returns:
+    - str: The cipher name, in lower case.
+
+    Raises:
+    - ValueError: If the cipher name is unknown.
+    - ImportError: If the "nacl" cipher is requested and PyNaCl is not installed.
+    """
+    if cipher_name is None:
+        cipher_name = os.getenv(CIPHER_ENV, "")
+    cipher_name = cipher_name.strip().lower() or DEFAULT_CIPHER
+    if cipher_name not in ("fernet", "nacl"):
+        raise ValueError(
+            f'Unknown cipher "{cipher_name}" in {CIPHER_ENV}. Use "fernet" or "nacl"'
+        )
+    if cipher_name == "nacl" and SecretBox is None:
+        raise ImportError(
+            f'PyNaCl is required to use the "nacl" cipher set in {CIPHER_ENV}. '
+            "Install it with: pip install secman[nacl]"
+        )
+    return cipher_name
+
+
+def make_cipher(master_key, cipher_name=None):
+    """
+    Build a cipher for the given key, to be reused across many values.
+
+    For "fernet", the rfernet implementation is used if available, otherwise
+    the one from cryptography.
+
+    Parameters:
+    - master_key (str): The Fernet key used for encryption and decryption.
+    - cipher_name (str, optional): "fernet" or "nacl", see get_cipher_name.
+
+    Returns:
+    - Fernet or SecretBoxCipher: The cipher object.
+
+    Raises:
+    - ValueError: If the provided master_key or cipher_name is invalid.
+    - ImportError: If the "nacl" cipher is requested and PyNaCl is not installed.
+    """
+    cipher_name = get_cipher_name(cipher_name)
+    if not complies_with_fernet_key_definition(master_key):
+        raise ValueError("Invalid Fernet key")
+    if cipher_name == "nacl":
+        return SecretBoxCipher(master_key)
+    if RFernet is not None:
+        if isinstance(master_key, bytes):
+            master_key = master_key.decode()
+        return RFernet(master_key)
+    return Fernet(master_key)
+
+
+def cipher_for_token(ciphers, master_key, encrypted_value):
+    """
+    Get the cipher able to decrypt a value, building it only once per format.
+
+    Parameters:
+    - ciphers (dict): The ciphers built so far with master_key, by cipher name.
+      New ciphers are added to it.
+    - master_key (str): The Fernet key used for decryption.
+    - encrypted_value (str): The encrypted value to be decrypted.
+
+    Returns:
+    - Fernet or SecretBoxCipher: The cipher object.
+
+    Raises:
+    - ValueError: If the provided master_key is invalid.
+    - ImportError: If the value is a SecretBox token and PyNaCl is not installed.
+    """
+    cipher_name = cipher_name_for_token(encrypted_value)
+    if cipher_name not in ciphers:
+        ciphers[cipher_name] = make_cipher(master_key, cipher_name)
+    return ciphers[cipher_name]
+
+
+def encrypt_value_with(cipher, value):
+    """
+    Encrypt a value with a cipher previously built by make_cipher.
+
+    Parameters:
+    - cipher (Fernet or SecretBoxCipher): The cipher used for encryption.
+    - value (str): The value to be encrypted.
+
+    Returns:
+    - str: The encrypted value.
+    """
+    encrypted_value = cipher.encrypt(value.encode())
+    if isinstance(encrypted_value, bytes):
+        encrypted_value = encrypted_value.decode()
+    return encrypted_value
+
+
+def decrypt_value_with(cipher, encrypted_value):
+    """
+    Decrypt a value with a cipher previously built by make_cipher.
+
+    Parameters:
+    - cipher (Fernet or SecretBoxCipher): The cipher used for decryption.
+    - encrypted_value (str): The encrypted value to be decrypted.
+
+    Returns:
+    - str: The decrypted value.
+
+    Raises:
+    - ValueError: If the encrypted value is not a valid token for the cipher.
+    """
+    # rfernet takes the token as str, the other ciphers as bytes
+    if RFernet is not None and isinstance(cipher, RFernet):
+        if isinstance(encrypted_value, bytes):
+            encrypted_value = encrypted_value.decode()
+    elif isinstance(encrypted_value, str):
+        encrypted_value = encrypted_value.encode()
+    try:
+        decrypted_value = cipher.decrypt(encrypted_value)
+    except Exception as e:
+        # cryptography and rfernet raise different exception types
+        raise ValueError("Invalid token") from e
+    if isinstance(decrypted_value, bytes):
+        decrypted_value = decrypted_value.decode()
+    return decrypted_value
+
+
 def encrypt_value(value, master_key):
     """
-    Encrypt a value using the Fernet symmetric encryption algorithm.
+    Encrypt a value using the Fernet symmetric encryption algorithm,
+    or SecretBox if SECMAN_CIPHER is set to "nacl".
 
     Parameters:
     - value (str): The value to be encrypted.
@@ -123,18 +335,15 @@ def encrypt_value(value, master_key):
     - str: The encrypted value.
 
     Raises:
-    - Exception: If the provided master_key is invalid.
+    - ValueError: If the provided master_key is invalid.
     """
-    if not complies_with_fernet_key_definition(master_key):
-        raise Exception("Invalid Fernet key")
-    fernet = Fernet(master_key)
-    encrypted_value = fernet.encrypt(value.encode())
-    return encrypted_value.decode()
+    return encrypt_value_with(make_cipher(master_key), value)
 
 
 def decrypt_value(encrypted_value, master_key):
     """
-    Decrypt a value using the Fernet symmetric encryption algorithm.
+    Decrypt a value using the Fernet symmetric encryption algorithm,
+    or SecretBox for values encrypted with it.
 
     Parameters:
     - encrypted_value (bytes): The encrypted value to be decrypted.
@@ -144,10 +353,8 @@ def decrypt_value(encrypted_value, master_key):
     - decrypted_value (str): The decrypted value as a string.
 
     Raises:
-    - Exception: If the provided master_key is not a valid Fernet key.
+    - ValueError: If the provided master_key is not a valid Fernet key, or
+      the encrypted value is not a valid token for it.
     """
-    if not complies_with_fernet_key_definition(master_key):
-        raise Exception("Invalid Fernet key")
-    fernet = Fernet(master_key)
-    decrypted_value = fernet.decrypt(encrypted_value).decode()
-    return decrypted_value
+    cipher = make_cipher(master_key, cipher_name_for_token(encrypted_value))
+    return decrypt_value_with(cipher, encrypted_value)
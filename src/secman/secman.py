@@ -66,7 +66,7 @@ The target file should have the following format:
         1. Concatenate the <ENCRYPTED_VALUE>, <DATETIME> and <MASTER_KEY> values
         2. Calculate the SHA256 hash of the concatenated value
         3. Encode the hash as a base64 string
-        4. The result is the <SIGNATURE> value
+        4. The last 8 characters of the result are the <SIGNATURE> value
 
 References:
   - Approaches to storing secrets:
@@ -89,19 +89,47 @@ Date: 2024-06-26
 
 
 import importlib.util
+import itertools
+import mmap
 import sys
+import shutil
 import hashlib
 import os
 import argparse
 import base64
 import re
 import datetime
-from secman.libs.crypto_utils import decrypt_value, encrypt_value, generate_key
+from contextlib import closing, contextmanager
+from secman.libs.crypto_utils import (
+    cipher_for_token,
+    decrypt_value,
+    decrypt_value_with,
+    encrypt_value,
+    encrypt_value_with,
+    generate_key,
+    get_cipher_name,
+    make_cipher,
+)
 
 
 HEADER_DISCLAIMER = (
     "# Generated by secman.py. Do not edit manually, unless you know what you are doing"
 )
+HEADER_DISCLAIMER_B = HEADER_DISCLAIMER.encode()
+
+# Buffer size used when reading secrets files
+_READ_BUFFER_SIZE = 1024 * 1024
+# Files from this size on are memory mapped when read in binary mode
+_MMAP_THRESHOLD = 1024 * 1024
+
+# Matches whole '<name> = "<value>"' secret lines in the bytes of a file,
+# capturing name and value
+_SECRET_LINE_RE = re.compile(
+    rb'^[ \t]*(?P<name>[a-zA-Z_][a-zA-Z0-9_]*)[ \t]*=[ \t]*["\'](?P<value>.*?)["\'][^\n]*\n?',
+    re.MULTILINE,
+)
+# Matches the "MASTER_KEY_ENV =" assignment
+_MASTER_KEY_RE = re.compile(r"^\s*MASTER_KEY_ENV\s*=")
 
 HEADER = """
 #  SECRET KEYS file
@@ -129,6 +157,127 @@ CCC = "secret"
 """
 
 
+def _create_temp_file(file_path):
+    """
+    Create a new empty file next to file_path, returning its descriptor and path
+
+    Like open(), the file is created with mode 0o666 and the kernel applies
+    the umask to it
+    """
+    directory, name = os.path.split(file_path)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+    while True:
+        tmp_path = os.path.join(directory, f".{name}.{os.urandom(4).hex()}.tmp")
+        try:
+            return os.open(tmp_path, flags, 0o666), tmp_path
+        except FileExistsError:
+            continue
+
+
+@contextmanager
+def _atomic_open(file_path, binary=False):
+    """
+    Open a temporary file next to file_path for writing (in binary mode if
+    requested), and move it over file_path once the block finishes without errors
+
+    If anything fails while writing, the temporary file is removed and
+    file_path is left untouched. An existing file_path keeps its permission
+    bits, and a new one gets the default ones for the current umask, as
+    if it had been created with open()
+
+    Any handle on file_path must be closed before the block finishes, as
+    some platforms (Windows) do not allow replacing open or mapped files
+    """
+    fd, tmp_path = _create_temp_file(file_path)
+    try:
+        with open(fd, "wb" if binary else "w") as tmp:
+            yield tmp
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _iter_lines_mmap(file_path):
+    """
+    Yield the lines of file_path, as bytes, reading them from a memory map
+    """
+    with open(file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter(mm.readline, b"")
+
+
+@contextmanager
+def _map_file(file_path):
+    """
+    Provide the whole content of file_path as bytes, memory mapped for large files
+    """
+    with open(file_path, "rb") as f:
+        if os.path.getsize(file_path) < _MMAP_THRESHOLD:
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def _open_lines(file_path, binary=False):
+    """
+    Open file_path to iterate its lines, as bytes if binary is True
+
+    Large files read in binary mode are memory mapped instead of read
+    through a buffer
+    """
+    if binary and os.path.getsize(file_path) >= _MMAP_THRESHOLD:
+        return closing(_iter_lines_mmap(file_path))
+    return open(file_path, "rb" if binary else "r", buffering=_READ_BUFFER_SIZE)
+
+
+def _rewrite(file_path, transform, output_path=None, binary=False):
+    """
+    Pass the lines of file_path through transform, and atomically write
+    the resulting lines to output_path (file_path if not provided)
+
+    With binary=True, the lines are handled as bytes, saving the decoding of
+    lines the transform does not need as text
+
+    transform receives an iterable over the input lines and returns an
+    iterable of lines, which are streamed to the output. The input is closed
+    (or unmapped) before the output replaces any file, so file_path can also
+    be the output path on every platform
+    """
+    with _atomic_open(output_path or file_path, binary) as fout:
+        with _open_lines(file_path, binary) as fin:
+            fout.writelines(transform(fin))
+
+
+def _unquote(value):
+    """
+    Strip the surrounding whitespaces and one pair of matching quotes of a value
+    """
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        return value[1:-1]
+    return value
+
+
+def compute_signature(encrypted_value, current_datetime, master_key):
+    """
+    Compute the signature of an encrypted secret
+
+    SHA256 of <ENCRYPTED_VALUE>, <DATETIME> and <MASTER_KEY> concatenated,
+    encoded as a base64 string
+    """
+    h = hashlib.sha256()
+    h.update(encrypted_value.encode())
+    h.update(current_datetime.encode())
+    h.update(master_key.encode())
+    return base64.b64encode(h.digest()).decode()
+
+
 def load_config_file(module_name, filename):
     try:
         spec = importlib.util.spec_from_file_location(module_name, filename)
@@ -164,30 +313,32 @@ def get_master_key(env_variable):
 def list_secrets(file_path):
     """
     List all secrets in the target file
+
+    Comments, empty lines and lines without an assignment are skipped
     """
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-        for line in lines:
-            if line.startswith("#") or line.strip() == "":
-                continue
-            secret_name = line.split("=")[0].strip()
-            print(secret_name)
+    with open(file_path, "r", buffering=_READ_BUFFER_SIZE) as file:
+        sys.stdout.writelines(
+            line.partition("=")[0].strip() + "\n"
+            for line in file
+            if not line.lstrip().startswith("#") and "=" in line
+        )
 
 
 def delete_secret(file_path, secret_name):
     """
     Delete a secret from the target file
     """
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-    with open(file_path, "w") as file:
+
+    def delete_lines(lines):
         for line in lines:
             if line.startswith("#") or line.strip() == "":
-                file.write(line)
+                yield line
                 continue
-            if line.split("=")[0].strip() == secret_name:
+            if line.partition("=")[0].strip() == secret_name:
                 continue
-            file.write(line)
+            yield line
+
+    _rewrite(file_path, delete_lines)
 
 
 def encrypt_secrets(file_path, master_key_env, master_key=None, overwrite=False):
@@ -197,56 +348,85 @@ def encrypt_secrets(file_path, master_key_env, master_key=None, overwrite=False)
     count_encrypted = 0
     if not master_key:
         master_key = os.getenv(master_key_env)
-    lines = open(file_path, "r").readlines()
-    encrypted_secrets = set()
-    # Build a list of currently existing <name>_ENCRYPTED values in the file
-    encrypted_pattern = re.compile(r"^\s*([a-zA-Z_][a-zA-Z0-9_]*)_ENCRYPTED\s*=")
-    for line in lines:
-        match = encrypted_pattern.match(line)
-        if match:
-            encrypted_secrets.add(match.group(1))
+    # A wrong cipher selection is reported straight away, on its own
+    try:
+        cipher_name = get_cipher_name()
+    except (ValueError, ImportError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    # Build the cipher once and reuse it for every secret in the file.
+    # An invalid key is only reported if there is something to encrypt.
+    try:
+        cipher = make_cipher(master_key, cipher_name)
+    except ValueError:
+        cipher = None
     if overwrite:
         output_file = file_path
     else:
         output_file = file_path.replace(".py", "_encrypted.py")
-    with open(output_file, "w") as file:
-        if lines[0].strip() != HEADER_DISCLAIMER:
-            file.write(HEADER_DISCLAIMER + "\n")
-        for line in lines:
-            if line.startswith("#") or line.strip() == "" or "=" not in line:
-                file.write(line)
+
+    # Walk the file once, as bytes. Lines holding a secret to encrypt are
+    # left as a placeholder in the output, and resolved at the end, once we
+    # know every <name>_ENCRYPTED value present in the file. Only the names
+    # and values of those secrets are decoded
+    def encrypt_lines(fin):
+        nonlocal count_encrypted
+        encrypted_secrets = set()
+        pending = []  # (output index, secret name, secret value)
+        output = []
+        lines = iter(fin)
+        first_line = next(lines, b"")
+        # New lines follow the line ending used by the input file
+        newline = "\r\n" if first_line.endswith(b"\r\n") else "\n"
+        if not first_line.startswith(HEADER_DISCLAIMER_B):
+            output.append(HEADER_DISCLAIMER_B + newline.encode())
+        for line in itertools.chain((first_line,), lines):
+            if line.startswith(b"#") or not line.strip() or b"=" not in line:
+                output.append(line)
                 continue
-            secret_name, secret_value = line.split("=", 1)
+            secret_name, _, secret_value = line.partition(b"=")
             secret_name = secret_name.strip()  # Remove starting or ending whitespaces
-            secret_value = secret_value.strip().strip('"')
-            if secret_name == "MASTER_KEY_ENV":
-                file.write(line)
-            elif secret_name.strip().endswith("_ENCRYPTED"):
-                file.write(line)
-            elif secret_name in encrypted_secrets:
-                file.write(f'{secret_name} = ""\n')
+            if secret_name == b"MASTER_KEY_ENV":
+                output.append(line)
+            elif secret_name.endswith(b"_ENCRYPTED"):
+                encrypted_secrets.add(secret_name[:-10])
+                output.append(line)
+            else:
+                pending.append((len(output), secret_name, secret_value))
+                output.append(line)
+        # All the secrets encrypted in a run share the same timestamp
+        current_datetime = datetime.datetime.now().isoformat(" ", "seconds")
+        for index, secret_name, secret_value in pending:
+            already_encrypted = secret_name in encrypted_secrets
+            secret_name = secret_name.decode()
+            secret_value = _unquote(secret_value.decode())
+            if already_encrypted:
+                output[index] = f'{secret_name} = ""{newline}'.encode()
                 if secret_value:
                     print(
                         f"Skipping {secret_name}: already encrypted in the file.\n        To re-encrypt it, delete the line and run the script again"
                     )
-            else:
+            elif secret_value:  # Empty secrets are not encrypted
                 try:
-                    encrypted_value = encrypt_value(secret_value, master_key)
+                    encrypted_value = encrypt_value_with(cipher, secret_value)
                 except Exception:
                     print(
                         "Error encrypting. Ensure you are providing a valid Fernet key."
                     )
                     sys.exit(1)
-                current_datetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                signature = base64.b64encode(
-                    hashlib.sha512(f"{master_key}".encode()).digest()
-                ).decode()
-                encrypted_line = f'{secret_name} = ""\n{secret_name}_ENCRYPTED = "{encrypted_value}"    # {master_key_env},{signature[-8:]},{current_datetime}\n'
-                file.write(encrypted_line)
+                signature = compute_signature(
+                    encrypted_value, current_datetime, master_key
+                )
+                output[index] = (
+                    f'{secret_name} = ""{newline}{secret_name}_ENCRYPTED = "{encrypted_value}"    # {master_key_env},{signature[-8:]},{current_datetime}{newline}'
+                ).encode()
                 count_encrypted += 1
                 print(
                     f"Encrypted {secret_name}. Variable for decrypted value has been written as empty string in the output file."
                 )
+        return output
+
+    _rewrite(file_path, encrypt_lines, output_file, binary=True)
     return count_encrypted
 
 
@@ -259,48 +439,64 @@ def decrypt_secrets(file_path, master_key_env, master_key=None, overwrite=False)
     if not master_key:
         print(f"Error: {master_key_env} environment variable is not set")
         return
-    # Build a list of existing encrypted secrets (<name>_ENCRYPTED) in the file
-    encrypted_secrets = set()
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-    encrypted_pattern = re.compile(r"^\s*([a-zA-Z_][a-zA-Z0-9_]*_ENCRYPTED)\s*=")
-    for line in lines:
-        match = encrypted_pattern.match(line)
-        if match:
-            encrypted_secrets.add(match.group(1))
     if overwrite:
         output_file = file_path
     else:
         output_file = file_path.replace(".py", "_decrypted.py")
-    # Process the file:
+
+    def kept_lines(text):
+        # Preserve comments and empty lines, other lines are removed
+        for line in text.splitlines(keepends=True):
+            if line.startswith(b"#") or not line.strip():
+                yield line
+
+    # Process the file with a single regular expression scan:
     # - If the line is a comment or empty, write it as is
     # - If the line is a secret, decrypt it and write the decrypted value
     # - other lines are removed
-    with open(output_file, "w") as file:
-        for line in lines:
-            # Preserve comments and empty lines
-            if line.startswith("#") or line.strip() == "":
-                file.write(line)
-                continue
-            # Identify and Process the secret lines
-            match = re.search(r'([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*["\'](.*?)["\']', line)
-            if match:
-                secret_name = match.group(1)
-                encrypted_value = match.group(2)
-                # If the secret_name value found does not end with _ENCRYPTED and
-                # the secret_name+"_ENCRYPTED" is not in the encrypted_secrets set then
-                # write the line as is else skip the line
-                if secret_name == "MASTER_KEY_ENV":
-                    file.write(line)
-                elif (
-                    not secret_name.endswith("_ENCRYPTED")
-                    and f"{secret_name}_ENCRYPTED" not in encrypted_secrets
-                ):
-                    file.write(f'{secret_name} = "{encrypted_value}"\n')
-                elif secret_name.endswith("_ENCRYPTED"):
-                    decrypted_value = decrypt_value(encrypted_value, master_key)
-                    decrypted_line = f'{secret_name[:-10]} = "{decrypted_value}"\n'
-                    file.write(decrypted_line)
+    with _map_file(file_path) as data:
+        # Rewritten lines follow the line ending used by the input file
+        first_newline = data.find(b"\n")
+        if first_newline > 0 and data[first_newline - 1 : first_newline] == b"\r":
+            newline = b"\r\n"
+        else:
+            newline = b"\n"
+        matches = list(_SECRET_LINE_RE.finditer(data))
+        # Build a list of existing encrypted secrets (<name>_ENCRYPTED) in the file
+        encrypted_secrets = {
+            m["name"][:-10] for m in matches if m["name"].endswith(b"_ENCRYPTED")
+        }
+        pending = []  # (output index, secret name, encrypted value)
+        output = []
+        position = 0
+        for match in matches:
+            output.extend(kept_lines(data[position : match.start()]))
+            position = match.end()
+            secret_name = match["name"]
+            value = match["value"]
+            # If the secret_name value found does not end with _ENCRYPTED and
+            # the secret_name is not in the encrypted_secrets set then
+            # write the line as is else skip the line
+            if secret_name == b"MASTER_KEY_ENV":
+                output.append(match[0])
+            elif secret_name.endswith(b"_ENCRYPTED"):
+                pending.append((len(output), secret_name[:-10], value.decode()))
+                output.append(None)
+            elif secret_name not in encrypted_secrets:
+                output.append(b'%s = "%s"%s' % (secret_name, value, newline))
+        output.extend(kept_lines(data[position:]))
+    # The ciphers are built once per token format, and reused for every secret
+    ciphers = {}
+    for index, secret_name, encrypted_value in pending:
+        cipher = cipher_for_token(ciphers, master_key, encrypted_value)
+        decrypted_value = decrypt_value_with(cipher, encrypted_value)
+        output[index] = b'%s = "%s"%s' % (
+            secret_name,
+            decrypted_value.encode(),
+            newline,
+        )
+    with _atomic_open(output_file, binary=True) as file:
+        file.writelines(output)
 
 
 def convert_secrets(file_path, old_master_key, new_master_key):
@@ -332,14 +528,15 @@ def set_master_key(file_path, master_key_env):
     """
     Set the MASTER_KEY_ENV value in the target file
     """
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-    with open(file_path, "w") as file:
+
+    def set_master_key_lines(lines):
         for line in lines:
-            if re.match(r"^\s*MASTER_KEY_ENV\s*=", line):
-                file.write(f'MASTER_KEY_ENV = "{master_key_env}"\n')
+            if "MASTER_KEY_ENV" in line and _MASTER_KEY_RE.match(line):
+                yield f'MASTER_KEY_ENV = "{master_key_env}"\n'
             else:
-                file.write(line)
+                yield line
+
+    _rewrite(file_path, set_master_key_lines)
 
 
 def create_example_file(file_path):
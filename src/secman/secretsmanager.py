@@ -5,7 +5,7 @@ Module with the Class to be used in python modules to decrypt secrets
 """
 
 import os
-from .libs.crypto_utils import decrypt_value
+from .libs.crypto_utils import cipher_for_token, decrypt_value_with
 
 
 class SecretsManager(object):
@@ -26,6 +26,7 @@ class SecretsManager(object):
         """
         self.key_env = key_env
         self.key = key
+        self._ciphers = {}  # cipher name -> cipher built with self.key
         if not self.key:
             self.key = os.getenv(self.key_env)
             if not self.key:
@@ -40,4 +41,5 @@ class SecretsManager(object):
         Returns:
             str: The decrypted value
         """
-        return decrypt_value(value, self.key)
+        cipher = cipher_for_token(self._ciphers, self.key, value)
+        return decrypt_value_with(cipher, value)
@@ -9,11 +9,17 @@ References:
 import sys
 import os
 import unittest
+from unittest import mock
 from cryptography.fernet import Fernet
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from secman.libs import crypto_utils
 from secman.libs.crypto_utils import decrypt_value
 from secman.libs.crypto_utils import derive_key, encrypt_value
 from secman.libs.crypto_utils import is_valid_fernet_key
+from secman.libs.crypto_utils import make_cipher, encrypt_value_with, decrypt_value_with
+from secman.libs.crypto_utils import cipher_for_token
+from secman.libs.crypto_utils import SecretBox, cipher_name_for_token
+from secman.libs.crypto_utils import get_cipher_name
 
 
 class TestCrypto_FernetKeyValidation(unittest.TestCase):
@@ -43,6 +49,120 @@ class TestCrypto_EncDecWithFernetKey(unittest.TestCase):
         self.assertEqual(self.value, decrypted_value)
 
 
+class TestCrypto_EncDecWithCipher(unittest.TestCase):
+    def setUp(self):
+        self.master_key = Fernet.generate_key().decode()
+        self.values = ["Hello, World!", "bye", "secret"]
+
+    def test_encryption_decryption_reusing_cipher(self):
+        cipher = make_cipher(self.master_key)
+        encrypted_values = [encrypt_value_with(cipher, v) for v in self.values]
+        # Values encrypted with a shared cipher are compatible with the plain API
+        decrypted_values = [decrypt_value(v, self.master_key) for v in encrypted_values]
+        self.assertEqual(self.values, decrypted_values)
+        self.assertEqual(
+            decrypt_value_with(cipher, encrypt_value(self.values[0], self.master_key)),
+            self.values[0],
+        )
+
+    def test_cipher_for_token(self):
+        ciphers = {}
+        for value in self.values:
+            encrypted_value = encrypt_value(value, self.master_key)
+            cipher = cipher_for_token(ciphers, self.master_key, encrypted_value)
+            self.assertEqual(decrypt_value_with(cipher, encrypted_value), value)
+        # A single cipher is built for all the Fernet tokens
+        self.assertEqual(list(ciphers), ["fernet"])
+        self.assertIs(ciphers["fernet"], cipher)
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            make_cipher("my_master_key")
+
+    def test_decrypt_with_wrong_key(self):
+        encrypted_value = encrypt_value(self.values[0], self.master_key)
+        other_cipher = make_cipher(Fernet.generate_key())
+        with self.assertRaises(ValueError):
+            decrypt_value_with(other_cipher, encrypted_value)
+
+    def test_cipher_name(self):
+        self.assertEqual(get_cipher_name(" Fernet "), "fernet")
+        self.assertEqual(get_cipher_name(""), "fernet")
+        with self.assertRaises(ValueError):
+            get_cipher_name("aes")
+        with self.assertRaises(ValueError):
+            make_cipher(self.master_key, "aes")
+
+
+class RFernetStub(object):
+    """Stand-in for rfernet.Fernet, with its str based interface"""
+
+    def __init__(self, key: str) -> None:
+        if not isinstance(key, str):
+            raise TypeError("key must be str")
+        self._fernet = Fernet(key)
+
+    def encrypt(self, data: bytes) -> str:
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+        return self._fernet.encrypt(data).decode()
+
+    def decrypt(self, token: str) -> bytes:
+        if not isinstance(token, str):
+            raise TypeError("token must be str")
+        return self._fernet.decrypt(token.encode())
+
+
+class TestCrypto_EncDecWithRFernet(unittest.TestCase):
+    def setUp(self):
+        self.master_key = Fernet.generate_key().decode()
+        self.value = "Hello, World!"
+        patcher = mock.patch.object(crypto_utils, "RFernet", RFernetStub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_encryption_decryption(self):
+        cipher = make_cipher(self.master_key)
+        self.assertIsInstance(cipher, RFernetStub)
+        encrypted_value = encrypt_value_with(cipher, self.value)
+        self.assertEqual(decrypt_value_with(cipher, encrypted_value), self.value)
+        self.assertEqual(
+            decrypt_value_with(cipher, encrypted_value.encode()), self.value
+        )
+        # Tokens are compatible with the Fernet implementation of cryptography
+        self.assertEqual(
+            Fernet(self.master_key).decrypt(encrypted_value.encode()).decode(),
+            self.value,
+        )
+
+
+@unittest.skipIf(SecretBox is None, "PyNaCl is not installed")
+class TestCrypto_EncDecWithSecretBox(unittest.TestCase):
+    def setUp(self):
+        self.master_key = Fernet.generate_key().decode()
+        self.value = "Hello, World!"
+
+    def test_encryption_decryption(self):
+        cipher = make_cipher(self.master_key, "nacl")
+        encrypted_value = encrypt_value_with(cipher, self.value)
+        self.assertEqual(cipher_name_for_token(encrypted_value), "nacl")
+        # decrypt_value detects the token format by itself
+        self.assertEqual(decrypt_value(encrypted_value, self.master_key), self.value)
+
+    def test_fernet_tokens_are_detected(self):
+        encrypted_value = encrypt_value_with(
+            make_cipher(self.master_key, "fernet"), self.value
+        )
+        self.assertEqual(cipher_name_for_token(encrypted_value), "fernet")
+
+    def test_decrypt_with_wrong_key(self):
+        encrypted_value = encrypt_value_with(
+            make_cipher(self.master_key, "nacl"), self.value
+        )
+        with self.assertRaises(ValueError):
+            decrypt_value(encrypted_value, Fernet.generate_key().decode())
+
+
 class TestCrypto_InvalidCustomKey(unittest.TestCase):
     def setUp(self):
         self.master_key = "my_master_key"
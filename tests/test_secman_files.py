@@ -0,0 +1,264 @@
+"""Test cases for the way secman reads and rewrites the secrets files"""
+
+import io
+import os
+import re
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from secman import secman
+from secman.libs import crypto_utils
+from secman.libs.crypto_utils import encrypt_value
+
+
+class TestSecmanFilesSetter(unittest.TestCase):
+    """
+    Class which includes the environment set up for the tests
+    Each test works on its own files, in a temporary directory
+    """
+    @classmethod
+    def setUpClass(self):
+        """Run ONLY ONCE before all tests are run"""
+        # Set the environment variable for the master key password
+        os.environ["MKEYPASSWD"] = "FQRDX23t2Gp0C_BlpgOLG6-uHLxxAN4P2bl4qrp4sBY="
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def write_file(self, name, content):
+        """Write the bytes content to a file in the temporary directory"""
+        file_path = os.path.join(self.tmp_dir.name, name)
+        with open(file_path, "wb") as file:
+            file.write(content)
+        return file_path
+
+    def read_file(self, file_path):
+        with open(file_path, "rb") as file:
+            return file.read()
+
+    def run_quiet(self, func, *args, **kwargs):
+        """Run func hiding what it prints, returning its result and its output"""
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            result = func(*args, **kwargs)
+        return result, stdout.getvalue()
+
+
+class TestSecmanRewrite(TestSecmanFilesSetter):
+    def test_rewrite(self):
+        """The transformed lines replace the content of the file"""
+        file_path = self.write_file("secrets.py", b"a\nb\n")
+        secman._rewrite(file_path, lambda lines: (line.upper() for line in lines))
+        self.assertEqual(self.read_file(file_path), b"A\nB\n")
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["secrets.py"])
+
+    def test_rewrite_failure_keeps_the_file(self):
+        """If the transform fails the file is untouched and no temporary file is left"""
+
+        def failing_transform(lines):
+            yield next(iter(lines))
+            raise RuntimeError("transform failed")
+
+        file_path = self.write_file("secrets.py", b"a\nb\n")
+        with self.assertRaises(RuntimeError):
+            secman._rewrite(file_path, failing_transform)
+        self.assertEqual(self.read_file(file_path), b"a\nb\n")
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["secrets.py"])
+
+    @unittest.skipIf(os.name == "nt", "Permission bits are not supported on Windows")
+    def test_rewrite_file_modes(self):
+        """A new output file follows the umask, an existing one keeps its mode"""
+        file_path = self.write_file("secrets.py", b"a\n")
+        os.chmod(file_path, 0o600)
+        output_path = os.path.join(self.tmp_dir.name, "output.py")
+        umask = os.umask(0o027)
+        try:
+            secman._rewrite(file_path, iter, output_path)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(output_path).st_mode & 0o777, 0o640)
+        secman._rewrite(file_path, iter)
+        self.assertEqual(os.stat(file_path).st_mode & 0o777, 0o600)
+
+    def test_rewrite_streams_the_lines(self):
+        """Lines are written as the transform yields them, the input is closed first"""
+        file_path = self.write_file("secrets.py", b"a\nb\n")
+        written = []
+
+        def transform(lines):
+            for line in lines:
+                written.append(os.listdir(self.tmp_dir.name))
+                yield line
+
+        secman._rewrite(file_path, transform)
+        # The temporary output file exists while the input is being read
+        self.assertEqual(len(written[0]), 2)
+        self.assertEqual(self.read_file(file_path), b"a\nb\n")
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["secrets.py"])
+
+
+class TestSecmanList(TestSecmanFilesSetter):
+    def test_list_secrets(self):
+        """Only the names of the assignments are listed"""
+        file_path = self.write_file(
+            "secrets.py",
+            b'# A = "comment"\n\n  # B = "indented comment"\nC = "c"\nprint()\n D = "d"\n',
+        )
+        _, output = self.run_quiet(secman.list_secrets, file_path)
+        self.assertEqual(output, "C\nD\n")
+
+
+class TestSecmanEdit(TestSecmanFilesSetter):
+    content = (
+        b"# comment\n"
+        b'MASTER_KEY_ENV = "MKEYPASSWD"\n'
+        b"\n"
+        b'TOKEN = ""\n'
+        b'TOKEN_ENCRYPTED = "abc"    # MKEYPASSWD,12345678,2024-01-01 00:00:00\n'
+        b'OTHER = "other"\n'
+    )
+
+    def assert_mode_kept(self, file_path):
+        if os.name != "nt":  # Permission bits are not supported on Windows
+            self.assertEqual(os.stat(file_path).st_mode & 0o777, 0o600)
+
+    def test_delete_secret(self):
+        """Only the lines of the deleted secret are removed"""
+        file_path = self.write_file("secrets.py", self.content)
+        os.chmod(file_path, 0o600)
+        secman.delete_secret(file_path, "TOKEN_ENCRYPTED")
+        self.assertEqual(
+            self.read_file(file_path),
+            self.content.replace(
+                b'TOKEN_ENCRYPTED = "abc"    # MKEYPASSWD,12345678,2024-01-01 00:00:00\n',
+                b"",
+            ),
+        )
+        self.assert_mode_kept(file_path)
+
+    def test_set_master_key(self):
+        """Only the MASTER_KEY_ENV line is replaced"""
+        file_path = self.write_file("secrets.py", self.content)
+        os.chmod(file_path, 0o600)
+        secman.set_master_key(file_path, "OTHERKEY")
+        self.assertEqual(
+            self.read_file(file_path),
+            self.content.replace(b'"MKEYPASSWD"\n', b'"OTHERKEY"\n'),
+        )
+        self.assert_mode_kept(file_path)
+
+
+class TestSecmanEncryptDecrypt(TestSecmanFilesSetter):
+    def test_single_quoted_values(self):
+        """Single quotes are not part of the encrypted value"""
+        file_path = self.write_file(
+            "secrets.py", b'MASTER_KEY_ENV = "MKEYPASSWD"\nTOKEN = \'abc\'\n'
+        )
+        self.run_quiet(secman.encrypt_secrets, file_path, "MKEYPASSWD", overwrite=True)
+        self.run_quiet(secman.decrypt_secrets, file_path, "MKEYPASSWD", overwrite=True)
+        self.assertIn(b'\nTOKEN = "abc"\n', self.read_file(file_path))
+
+    def test_empty_values_are_not_encrypted(self):
+        """Empty secrets are kept as they are in the encrypted file"""
+        file_path = self.write_file(
+            "secrets.py",
+            b'MASTER_KEY_ENV = "MKEYPASSWD"\nEMPTY = ""\nTOKEN = "abc"\n',
+        )
+        count, _ = self.run_quiet(secman.encrypt_secrets, file_path, "MKEYPASSWD")
+        self.assertEqual(count, 1)
+        content = self.read_file(file_path.replace(".py", "_encrypted.py"))
+        self.assertIn(b'\nEMPTY = ""\n', content)
+        self.assertNotIn(b"EMPTY_ENCRYPTED", content)
+        self.assertIn(b"TOKEN_ENCRYPTED", content)
+
+    def test_signature_trailer(self):
+        """Encrypted secrets are followed by the key name, signature and datetime"""
+        file_path = self.write_file(
+            "secrets.py", b'MASTER_KEY_ENV = "MKEYPASSWD"\nTOKEN = "abc"\n'
+        )
+        self.run_quiet(secman.encrypt_secrets, file_path, "MKEYPASSWD", overwrite=True)
+        match = re.search(
+            rb'^TOKEN_ENCRYPTED = "(?P<value>[^"]+)"    '
+            rb"# MKEYPASSWD,(?P<signature>.{8}),(?P<datetime>.+)\n",
+            self.read_file(file_path),
+            re.MULTILINE,
+        )
+        self.assertIsNotNone(match)
+        signature = secman.compute_signature(
+            match["value"].decode(),
+            match["datetime"].decode(),
+            os.environ["MKEYPASSWD"],
+        )
+        self.assertEqual(match["signature"].decode(), signature[-8:])
+
+    def test_decrypt_parser(self):
+        """Comments, empty lines and secrets are kept, any other line is removed"""
+        encrypted_value = encrypt_value("abc", os.environ["MKEYPASSWD"]).encode()
+        file_path = self.write_file(
+            "secrets.py",
+            b"# comment\n"
+            b'MASTER_KEY_ENV = "MKEYPASSWD"    # key\n'
+            b"\n"
+            b"  # indented comment\n"
+            b"print('not a secret')\n"
+            b'PLAIN = "plain"\n'
+            b'TOKEN = ""\n'
+            b'TOKEN_ENCRYPTED = "%s"    # MKEYPASSWD,12345678,2024-01-01 00:00:00\n'
+            % encrypted_value,
+        )
+        self.run_quiet(secman.decrypt_secrets, file_path, "MKEYPASSWD")
+        self.assertEqual(
+            self.read_file(file_path.replace(".py", "_decrypted.py")),
+            b"# comment\n"
+            b'MASTER_KEY_ENV = "MKEYPASSWD"    # key\n'
+            b"\n"
+            b'PLAIN = "plain"\n'
+            b'TOKEN = "abc"\n',
+        )
+
+    def test_decrypt_builds_the_cipher_once(self):
+        """A single cipher is used to decrypt all the secrets of a file"""
+        file_path = self.write_file(
+            "secrets.py",
+            b'MASTER_KEY_ENV = "MKEYPASSWD"\nA = "a"\nB = "b"\nC = "c"\n',
+        )
+        self.run_quiet(secman.encrypt_secrets, file_path, "MKEYPASSWD", overwrite=True)
+        with mock.patch.object(
+            crypto_utils, "make_cipher", wraps=crypto_utils.make_cipher
+        ) as make_cipher:
+            self.run_quiet(
+                secman.decrypt_secrets, file_path, "MKEYPASSWD", overwrite=True
+            )
+        self.assertEqual(make_cipher.call_count, 1)
+        self.assertIn(b'\nA = "a"\nB = "b"\nC = "c"\n', self.read_file(file_path))
+
+    def assert_crlf_round_trip(self):
+        file_path = self.write_file(
+            "secrets.py",
+            b'MASTER_KEY_ENV = "MKEYPASSWD"\r\n# comment\r\n\r\nTOKEN = "abc"\r\n',
+        )
+        self.run_quiet(secman.encrypt_secrets, file_path, "MKEYPASSWD", overwrite=True)
+        content = self.read_file(file_path)
+        self.assertIn(b"TOKEN_ENCRYPTED", content)
+        self.assertEqual(content.count(b"\n"), content.count(b"\r\n"))
+        self.run_quiet(secman.decrypt_secrets, file_path, "MKEYPASSWD", overwrite=True)
+        content = self.read_file(file_path)
+        self.assertIn(b'\r\nTOKEN = "abc"\r\n', content)
+        self.assertEqual(content.count(b"\n"), content.count(b"\r\n"))
+
+    def test_crlf_line_endings(self):
+        """Files with CRLF line endings are written back with CRLF only"""
+        self.assert_crlf_round_trip()
+
+    def test_crlf_line_endings_memory_mapped(self):
+        """Same as above, reading the file through a memory map"""
+        with mock.patch.object(secman, "_MMAP_THRESHOLD", 0):
+            self.assert_crlf_round_trip()
+
+
+if __name__ == "__main__":
+    unittest.main()
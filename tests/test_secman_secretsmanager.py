@@ -28,6 +28,15 @@ class TestSecretsManager(unittest.TestCase):
         decrypted_value = mysecman.decrypt_secret(encrypted_value)
         self.assertEqual(decrypted_value, expected_value)
 
+    def test_secretsmanager_reuses_its_cipher(self):
+        """The cipher is built once per manager"""
+        mysecman = SecretsManager()
+        encrypted_value = "gAAAAABmfDNjcB_dUdvMkvrZXCHqTwB2k56wOPsbo-d0roY7igZJWRmjlAEZSyq91TaI4n-lA2Sp3z6OOZZTMTIxYUagPrUa6Q=="
+        mysecman.decrypt_secret(encrypted_value)
+        cipher = mysecman._ciphers["fernet"]
+        self.assertEqual(mysecman.decrypt_secret(encrypted_value), "hello")
+        self.assertIs(mysecman._ciphers["fernet"], cipher)
+
 
 if __name__ == "__main__":
     unittest.main()